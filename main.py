@@ -10,58 +10,122 @@ Telegram-бот для проверки статусов заявлений MIDP
   только если изменился процент (internalStatus.percent).
 
 Зависимости:
-    pip install "python-telegram-bot[job-queue]" requests pillow
+    pip install "python-telegram-bot[job-queue,rate-limiter]" aiohttp pillow
+    pip install orjson  # необязательно, ускоряет чтение/запись JSON
+    pip install uvloop  # необязательно, более быстрый event loop (не Windows)
+    pip install "python-telegram-bot[webhooks]"  # только для режима webhook
 
 Перед запуском:
     1. Создайте бота через @BotFather и получите токен.
     2. Установите переменную окружения TELEGRAM_BOT_TOKEN с токеном бота.
     3. Запустите один раз `slice_progress_sprite.py`, чтобы создать папку
        progress_icons/ с картинками progress_0.png ... progress_100.png .
+    4. (Необязательно) Задайте PUBLIC_HOST (и при необходимости PORT), чтобы
+       получать обновления через webhook https://PUBLIC_HOST/<токен>
+       вместо long polling.
 """
 
 import asyncio
+import functools
 import json
 import logging
 import os
+import re
+import time
 from dataclasses import dataclass
 from datetime import time as dtime, timezone
+from enum import IntEnum
 from io import BytesIO
-from typing import Dict, List, Optional, Any
-
-import requests
-import urllib3
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него работает stdlib json
+    orjson = None
+try:
+    import uvloop
+except ImportError:  # uvloop необязателен, без него — стандартный event loop
+    uvloop = None
 from PIL import Image, ImageDraw, ImageFont
 from telegram import Update
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
 )
-from telegram.error import TimedOut, RetryAfter, NetworkError
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from telegram.error import BadRequest, TimedOut, RetryAfter, NetworkError
 
 # ---------------------- НАСТРОЙКИ ----------------------
 
 API_URL = "https://info.midpass.ru/api/request/{}"
 DAILY_CHECK_HOUR_UTC = 8
+# насколько можно опоздать с ежедневной проверкой (например, если цикл
+# событий был занят), прежде чем APScheduler пропустит запуск
+DAILY_CHECK_MISFIRE_GRACE = 60 * 60
+# сколько запросов к MIDPASS одновременно при массовой проверке
+MIDPASS_CONCURRENCY = 16
+# повторы при временных ошибках MIDPASS: пауза 0.5, 1, 2 с
+MIDPASS_RETRIES = 3
+MIDPASS_RETRY_BACKOFF = 0.5
+MIDPASS_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# сколько секунд считать полученный статус свежим
+STATUS_CACHE_TTL = 60.0
+STATUS_CACHE_MAXSIZE = 10_000
 SUBSCRIPTIONS_FILE = "subscriptions.json"
 CHAT_PREFS_FILE = "chat_prefs.json"
 LABELS_FILE = "labels.json"
+ICON_FILE_IDS_FILE = "icon_file_ids.json"
+# Журнал изменений: каждое изменение дописывается сюда одной строкой,
+# а JSON-файлы выше переписываются только при компактизации журнала.
+JOURNAL_FILE = "state.journal"
+JOURNAL_COMPACT_EVERY = 1000  # записей в журнале
+JOURNAL_COMPACT_INTERVAL = 15 * 60  # секунд
+# сколько секунд копить записи журнала перед одной дозаписью на диск
+JOURNAL_FLUSH_DELAY = 0.25
+
+# (chat_id, uid) -> ярлык: одна хеш-операция на поиск при каждой рассылке.
+# На диске хранится во вложенном виде {chat_id: {uid: ярлык}}.
+labels: Dict[Tuple[str, str], str] = {}
+# chat_id -> uid с ярлыками, чтобы /clear и /erase_data не перебирали все ярлыки
+_labelled_uids: Dict[str, Set[str]] = {}
+
+
+
+class Mode(IntEnum):
+    """Режим уведомлений; на диске и в журнале хранится числом."""
+
+    DAILY = 1
+    ON_CHANGE = 2
 
-labels: Dict[int, Dict[str, str]] = {}
 
-DEFAULT_NOTIFY_MODE = "on_change"  # или "daily" если захочешь другое по умолчанию
-# chat_id -> "on_change" | "daily"
-chat_notify_mode: Dict[int, str] = {}
+def _parse_mode(value: Any) -> Optional[Mode]:
+    """Число из нового формата или строка "daily"/"on_change" из старого."""
+    try:
+        if isinstance(value, str):
+            return Mode[value.upper()]
+        return Mode(value)
+    except (KeyError, ValueError):
+        return None
+
+
+DEFAULT_NOTIFY_MODE = Mode.ON_CHANGE  # или Mode.DAILY если захочешь другое по умолчанию
+# chat_id -> Mode
+chat_notify_mode: Dict[str, Mode] = {}
 
 # Папка с заранее нарезанными картинками:
 # progress_icons/progress_0.png, progress_5.png, ... progress_100.png
 PROGRESS_DIR = "progress_icons"
 PROGRESS_STEPS = [0, 5, 10, 20, 30, 60, 70, 80, 90, 100]
+# процент 0..100 -> ближайший шаг из PROGRESS_STEPS
+_NEAREST = [min(PROGRESS_STEPS, key=lambda v, p=p: abs(v - p)) for p in range(101)]
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
+# Если задан PUBLIC_HOST — получаем обновления через webhook, иначе long polling
+PUBLIC_HOST = os.getenv("PUBLIC_HOST", "").strip()
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
 
 API_HEADERS = {
     "User-Agent": (
@@ -82,7 +146,6 @@ logging.basicConfig(
 )
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
@@ -107,70 +170,418 @@ class RequestStatus:
     internal_status: InternalStatus
 
 
+# Ключи — chat_id и uid в виде строк, как в JSON-файлах: так не нужно
+# конвертировать их при каждом сохранении и поиске.
 # chat_id -> { uid: last_percent_or_None }
-subscriptions: Dict[int, Dict[str, Optional[int]]] = {}
+subscriptions: Dict[str, Dict[str, Optional[int]]] = {}
+# Обратный индекс: uid -> чаты, которые его отслеживают. Обновляется вместе
+# с subscriptions в _apply, чтобы ежедневной проверке не строить его заново.
+uid_to_chats: Dict[str, Set[str]] = {}
+
+# Общая HTTP-сессия для запросов к MIDPASS (создаётся в post_init)
+aiohttp_session: Optional[aiohttp.ClientSession] = None
+
+
+# ---------------------- ЖУРНАЛ И СНИМКИ СОСТОЯНИЯ ----------------------
+# хранилище -> (файл, функция, возвращающая текущие данные)
+_STORES: Dict[str, Tuple[str, Callable[[], Any]]] = {
+    "subs": (SUBSCRIPTIONS_FILE, lambda: subscriptions),
+    "labels": (LABELS_FILE, lambda: _labels_nested()),
+    "prefs": (CHAT_PREFS_FILE, lambda: chat_notify_mode),
+    "icons": (ICON_FILE_IDS_FILE, lambda: _icon_file_id),
+}
+# хранилища, изменённые с последней компактизации
+_dirty: Set[str] = set()
+# файл -> хеш последнего записанного содержимого
+_last_hash: Dict[str, int] = {}
+# маркер для dict.pop: отличает «ключа не было» от пустого значения
+_MISSING = object()
+_journal_fp: Optional[BinaryIO] = None
+_journal_records = 0
+_compaction_task: Optional["asyncio.Task[None]"] = None
+# Фоновая запись журнала (запускается в post_init): обработчики только
+# складывают строки в буфер, а на диск они уходят пачкой в отдельном потоке.
+_journal_buffer: List[bytes] = []
+_journal_event: Optional[asyncio.Event] = None
+# держится на время дозаписи и обрезки журнала, чтобы они не пересекались
+_journal_lock: Optional[asyncio.Lock] = None
+_journal_writer_task: Optional["asyncio.Task[None]"] = None
+
+
+def _json_dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def _json_line(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def _json_loads(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _read_json(path: str) -> Any:
+    with open(path, "rb") as f:
+        return _json_loads(f.read())
+
+
+def _write_bytes_atomic(path: str, data: bytes) -> None:
+    """Пишем во временный файл, fsync и подменяем им основной — файл не обрежется при падении."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _encode_stores(domains: Set[str]) -> List[Tuple[str, bytes]]:
+    """Сериализовать хранилища в bytes. Вызывать из потока event loop, где живут данные."""
+    payload: List[Tuple[str, bytes]] = []
+    for domain in sorted(domains):
+        path, get_data = _STORES[domain]
+        payload.append((path, _json_dumps(get_data())))
+    return payload
+
+
+def _write_files(payload: List[Tuple[str, bytes]]) -> None:
+    for path, data in payload:
+        h = hash(data)
+        if _last_hash.get(path) == h:
+            # содержимое то же, что уже на диске, — ни записи, ни fsync
+            logger.debug("Skipping unchanged %s", path)
+            continue
+        logger.info("Saving %s", path)
+        _write_bytes_atomic(path, data)
+        _last_hash[path] = h
+
+
+def save_all(dirty: Set[str]) -> None:
+    """Сразу записать перечисленные хранилища: сначала кодируем все, потом пишем файлы."""
+    _write_files(_encode_stores(dirty))
+
+
+# Операции журнала. Каждая задаёт итоговое значение ключа (или удаляет его),
+# поэтому повторное применение поверх более свежего снимка даёт то же состояние.
+def _unindex_uid(chat_id: str, uid: str) -> None:
+    chats = uid_to_chats.get(uid)
+    if chats is not None:
+        chats.discard(chat_id)
+        if not chats:
+            del uid_to_chats[uid]
+
+
+def _rebuild_uid_index() -> None:
+    uid_to_chats.clear()
+    for chat_id, uids in subscriptions.items():
+        for uid in uids:
+            uid_to_chats.setdefault(uid, set()).add(chat_id)
+
+
+def _apply(record: Dict[str, Any]) -> Set[str]:
+    """Применить запись журнала к памяти; вернуть затронутые хранилища."""
+    op = record["op"]
+    chat = record.get("chat")
+    if op == "sub":
+        subscriptions.setdefault(chat, {})[record["uid"]] = record["percent"]
+        uid_to_chats.setdefault(record["uid"], set()).add(chat)
+        return {"subs"}
+    if op == "unsub":
+        inner = subscriptions.get(chat)
+        if inner is not None:
+            inner.pop(record["uid"], None)
+            if not inner:
+                del subscriptions[chat]
+        _unindex_uid(chat, record["uid"])
+        return {"subs"}
+    if op == "label":
+        uid = record["uid"]
+        if record["label"] is None:
+            labels.pop((chat, uid), None)
+            uids = _labelled_uids.get(chat)
+            if uids is not None:
+                uids.discard(uid)
+                if not uids:
+                    del _labelled_uids[chat]
+        else:
+            labels[(chat, uid)] = record["label"]
+            _labelled_uids.setdefault(chat, set()).add(uid)
+        return {"labels"}
+    if op == "mode":
+        mode = _parse_mode(record["mode"])
+        if mode is None:
+            raise ValueError(f"unknown mode: {record['mode']!r}")
+        chat_notify_mode[chat] = mode
+        return {"prefs"}
+    if op == "drop":
+        # возвращаем только те хранилища, где у чата что-то действительно было
+        stores = set(record["stores"])
+        dropped: Set[str] = set()
+        if "subs" in stores:
+            uids = subscriptions.pop(chat, _MISSING)
+            if uids is not _MISSING:
+                for uid in uids:
+                    _unindex_uid(chat, uid)
+                dropped.add("subs")
+        if "labels" in stores:
+            uids = _labelled_uids.pop(chat, _MISSING)
+            if uids is not _MISSING:
+                for uid in uids:
+                    labels.pop((chat, uid), None)
+                dropped.add("labels")
+        if "prefs" in stores:
+            if chat_notify_mode.pop(chat, _MISSING) is not _MISSING:
+                dropped.add("prefs")
+        return dropped
+    if op == "icon":
+        if record["file_id"] is None:
+            _icon_file_id.pop(record["step"], None)
+        else:
+            _icon_file_id[record["step"]] = record["file_id"]
+        return {"icons"}
+    raise ValueError(f"unknown journal op {op!r}")
+
+
+def _append_journal(lines: List[bytes]) -> None:
+    global _journal_fp
+    try:
+        if _journal_fp is None:
+            _journal_fp = open(JOURNAL_FILE, "ab", buffering=0)
+        _journal_fp.write(b"".join(lines))
+    except OSError as e:
+        logger.error("Failed to append to journal %s: %s", JOURNAL_FILE, e)
+
+
+def _commit(op: str, **fields: Any) -> Set[str]:
+    """
+    Изменить состояние в памяти и поставить изменение в журнал (O(1) на вызов).
+    Возвращает затронутые хранилища; если ничего не изменилось, журнал не трогаем.
+    """
+    global _journal_records
+    record = {"op": op, **fields}
+    changed = _apply(record)
+    if not changed:
+        return changed
+    _dirty.update(changed)
+    line = _json_line(record)
+    if _journal_event is not None:
+        _journal_buffer.append(line)
+        _journal_event.set()
+    else:
+        # фоновой записи ещё нет (или уже нет) — пишем сразу
+        _append_journal([line])
+    _journal_records += 1
+    if _journal_records >= JOURNAL_COMPACT_EVERY:
+        _start_compaction()
+    return changed
+
+
+async def _flush_journal_buffer() -> None:
+    async with _journal_lock:
+        _journal_event.clear()
+        if not _journal_buffer:
+            return
+        lines = _journal_buffer[:]
+        _journal_buffer.clear()
+        await asyncio.to_thread(_append_journal, lines)
+
+
+async def _journal_writer() -> None:
+    while True:
+        await _journal_event.wait()
+        # даём набежать соседним изменениям, чтобы записать их одной пачкой
+        await asyncio.sleep(JOURNAL_FLUSH_DELAY)
+        await _flush_journal_buffer()
+
+
+def start_journal_writer() -> None:
+    global _journal_event, _journal_lock, _journal_writer_task
+    _journal_event = asyncio.Event()
+    _journal_lock = asyncio.Lock()
+    _journal_writer_task = asyncio.get_running_loop().create_task(_journal_writer())
+
+
+async def stop_journal_writer() -> None:
+    """Остановить фоновую запись и синхронно дописать то, что осталось в буфере."""
+    global _journal_event, _journal_lock, _journal_writer_task
+    if _journal_writer_task is None:
+        return
+    # под блокировкой писатель не может быть посреди дозаписи
+    async with _journal_lock:
+        _journal_writer_task.cancel()
+    try:
+        await _journal_writer_task
+    except asyncio.CancelledError:
+        pass
+    _journal_writer_task = None
+    _journal_event = None
+    _journal_lock = None
+    if _journal_buffer:
+        _append_journal(_journal_buffer[:])
+        _journal_buffer.clear()
+
+
+def replay_journal() -> None:
+    """При старте доиграть журнал поверх загруженных JSON-снимков."""
+    if not os.path.exists(JOURNAL_FILE):
+        return
+    applied = 0
+    with open(JOURNAL_FILE, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                _dirty.update(_apply(_json_loads(line)))
+                applied += 1
+            except Exception as e:
+                # например, оборванная последняя строка после падения
+                logger.warning("Skipping bad journal record %r: %s", line[:200], e)
+    logger.info("Replayed %d journal records from %s", applied, JOURNAL_FILE)
+
+
+def _journal_size() -> int:
+    try:
+        return os.path.getsize(JOURNAL_FILE)
+    except OSError:
+        return 0
+
+
+def _trim_journal(offset: int) -> None:
+    """Убрать из журнала первые offset байт — они уже попали в снимки."""
+    global _journal_fp
+    if _journal_fp is not None:
+        _journal_fp.close()
+        _journal_fp = None
+    try:
+        with open(JOURNAL_FILE, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+    except FileNotFoundError:
+        return
+    _write_bytes_atomic(JOURNAL_FILE, tail)
+
+
+def compact() -> None:
+    """Синхронно переписать изменённые снимки и очистить журнал (старт и остановка)."""
+    global _journal_records
+    try:
+        if _dirty:
+            save_all(set(_dirty))
+            _dirty.clear()
+        size = _journal_size()
+        if size:
+            _trim_journal(size)
+    except Exception as e:
+        logger.error("Journal compaction failed: %s", e)
+        return
+    _journal_records = 0
+
+
+async def compact_async() -> None:
+    """
+    Компактизация без блокировки event loop: снимки кодируем сразу,
+    а пишем в отдельном потоке. Записи, появившиеся в журнале за это время,
+    в нём и остаются.
+    """
+    global _journal_records
+    if not _dirty and not _journal_records:
+        return
+    async with _journal_lock:
+        dirty = set(_dirty)
+        _dirty.clear()
+        payload = _encode_stores(dirty)
+        # всё, что уже в файле журнала, отражено в payload
+        offset = _journal_size()
+        records = _journal_records
+    try:
+        await asyncio.to_thread(_write_files, payload)
+    except Exception as e:
+        logger.error("Journal compaction failed: %s", e)
+        _dirty.update(dirty)
+        return
+    # обрезка читает хвост журнала и делает fsync — тоже в отдельном потоке;
+    # под замком, чтобы дозапись журнала ждала её окончания
+    async with _journal_lock:
+        try:
+            await asyncio.to_thread(_trim_journal, offset)
+        except Exception as e:
+            # снимки уже записаны, а журнал доиграется поверх них без вреда;
+            # счётчик не трогаем, как и в compact()
+            logger.error("Journal compaction failed: %s", e)
+            return
+    _journal_records -= records
+    logger.info("Journal compacted (%d records)", records)
+
+
+def _start_compaction() -> None:
+    global _compaction_task
+    if _compaction_task is not None and not _compaction_task.done():
+        return
+    if _journal_lock is None:
+        # вне работающего бота (старт, остановка) — компактизируем синхронно
+        compact()
+        return
+    _compaction_task = asyncio.get_running_loop().create_task(compact_async())
+
+
+async def compact_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    _start_compaction()
 
 
 def load_labels() -> None:
-    global labels
+    global labels, _labelled_uids
     logger.info("Loading labels from %s", LABELS_FILE)
     if not os.path.exists(LABELS_FILE):
         labels = {}
+        _labelled_uids = {}
         return
     try:
-        with open(LABELS_FILE, "r", encoding="utf-8") as f:
-            raw = json.load(f)
+        raw = _read_json(LABELS_FILE)
 
-        parsed: Dict[int, Dict[str, str]] = {}
-        for chat_id_str, inner in raw.items():
-            try:
-                chat_id = int(chat_id_str)
-            except ValueError:
-                continue
-            if not isinstance(inner, dict):
+        parsed: Dict[Tuple[str, str], str] = {}
+        by_chat: Dict[str, Set[str]] = {}
+        for chat_id, inner in raw.items():
+            if not isinstance(inner, dict) or not inner:
                 continue
-            parsed[chat_id] = {str(uid): str(label) for uid, label in inner.items()}
+            for uid, label in inner.items():
+                parsed[(chat_id, str(uid))] = str(label)
+            by_chat[chat_id] = {str(uid) for uid in inner}
 
         labels = parsed
-        logger.info("Labels loaded: %s", labels)
+        _labelled_uids = by_chat
+        logger.info("Labels loaded for %d chats", len(_labelled_uids))
     except Exception as e:
         logger.error("Failed to load labels: %s", e)
         labels = {}
+        _labelled_uids = {}
 
 
-def save_labels() -> None:
-    logger.info("Saving labels to %s", LABELS_FILE)
-    try:
-        data = {
-            str(chat_id): {str(uid): label for uid, label in inner.items()}
-            for chat_id, inner in labels.items()
-        }
-        with open(LABELS_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        logger.info("Labels saved")
-    except Exception as e:
-        logger.error("Failed to save labels: %s", e)
+def _labels_nested() -> Dict[str, Dict[str, str]]:
+    """Ярлыки в формате файла: {chat_id: {uid: ярлык}}."""
+    nested: Dict[str, Dict[str, str]] = {}
+    for (chat_id, uid), label in labels.items():
+        nested.setdefault(chat_id, {})[uid] = label
+    return nested
 
 
-def get_label(chat_id: int, uid: str) -> Optional[str]:
-    return labels.get(chat_id, {}).get(str(uid))
+def get_label(chat_id: str, uid: str) -> Optional[str]:
+    return labels.get((chat_id, uid))
 
 
-def set_label(chat_id: int, uid: str, label: Optional[str]) -> None:
-    uid = str(uid)
+def set_label(chat_id: str, uid: str, label: Optional[str]) -> None:
     if not label or not label.strip():
         # delete label
-        if chat_id in labels and uid in labels[chat_id]:
-            del labels[chat_id][uid]
-            if not labels[chat_id]:
-                del labels[chat_id]
-            save_labels()
+        if (chat_id, uid) in labels:
+            _commit("label", chat=chat_id, uid=uid, label=None)
         return
 
-    if chat_id not in labels:
-        labels[chat_id] = {}
-    labels[chat_id][uid] = label.strip()
-    save_labels()
+    _commit("label", chat=chat_id, uid=uid, label=label.strip())
 
 
 def load_chat_prefs() -> None:
@@ -180,35 +591,21 @@ def load_chat_prefs() -> None:
         chat_notify_mode = {}
         return
     try:
-        with open(CHAT_PREFS_FILE, "r", encoding="utf-8") as f:
-            raw = json.load(f)
+        raw = _read_json(CHAT_PREFS_FILE)
 
-        prefs: Dict[int, str] = {}
-        for chat_id_str, mode in raw.items():
-            try:
-                chat_id = int(chat_id_str)
-            except ValueError:
-                continue
-            if mode in ("on_change", "daily"):
+        prefs: Dict[str, Mode] = {}
+        for chat_id, value in raw.items():
+            mode = _parse_mode(value)
+            if mode is not None:
                 prefs[chat_id] = mode
         chat_notify_mode = prefs
-        logger.info("Chat prefs loaded: %s", chat_notify_mode)
+        logger.info("Chat prefs loaded for %d chats", len(chat_notify_mode))
     except Exception as e:
         logger.error("Failed to load chat prefs: %s", e)
         chat_notify_mode = {}
 
 
-def save_chat_prefs() -> None:
-    logger.info("Saving chat prefs to %s", CHAT_PREFS_FILE)
-    try:
-        data = {str(chat_id): mode for chat_id, mode in chat_notify_mode.items()}
-        with open(CHAT_PREFS_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        logger.info("Chat prefs saved")
-    except Exception as e:
-        logger.error("Failed to save chat prefs: %s", e)
-
-def get_notify_mode(chat_id: int) -> str:
+def get_notify_mode(chat_id: str) -> Mode:
     return chat_notify_mode.get(chat_id, DEFAULT_NOTIFY_MODE)
 
 
@@ -233,19 +630,14 @@ def load_subscriptions() -> None:
     if not os.path.exists(SUBSCRIPTIONS_FILE):
         logger.info("Subscriptions file not found, starting with empty dict")
         subscriptions = {}
+        _rebuild_uid_index()
         return
 
     try:
-        with open(SUBSCRIPTIONS_FILE, "r", encoding="utf-8") as f:
-            raw = json.load(f)
-
-        migrated: Dict[int, Dict[str, Optional[int]]] = {}
-        for chat_id_str, v in raw.items():
-            try:
-                chat_id = int(chat_id_str)
-            except ValueError:
-                continue
+        raw = _read_json(SUBSCRIPTIONS_FILE)
 
+        migrated: Dict[str, Dict[str, Optional[int]]] = {}
+        for chat_id, v in raw.items():
             if isinstance(v, list):
                 # старый формат: просто список UID
                 migrated[chat_id] = {str(uid): None for uid in v}
@@ -258,95 +650,167 @@ def load_subscriptions() -> None:
                 migrated[chat_id] = {}
 
         subscriptions = migrated
-        logger.info("Subscriptions loaded (migrated): %s", subscriptions)
+        logger.info("Subscriptions loaded (migrated) for %d chats", len(subscriptions))
     except Exception as e:
         logger.error("Failed to load subscriptions: %s", e)
         subscriptions = {}
+    _rebuild_uid_index()
+
 
+# шаг прогресса -> file_id уже загруженной в Telegram картинки
+_icon_file_id: Dict[int, str] = {}
 
-def save_subscriptions() -> None:
-    """Сохранить подписки в JSON-файл (новый формат)."""
-    logger.info("Saving subscriptions to %s", SUBSCRIPTIONS_FILE)
+
+def load_icon_file_ids() -> None:
+    global _icon_file_id
+    logger.info("Loading icon file_ids from %s", ICON_FILE_IDS_FILE)
+    if not os.path.exists(ICON_FILE_IDS_FILE):
+        _icon_file_id = {}
+        return
     try:
-        data = {str(chat_id): inner for chat_id, inner in subscriptions.items()}
-        with open(SUBSCRIPTIONS_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        logger.info("Subscriptions saved")
+        raw = _read_json(ICON_FILE_IDS_FILE)
+        _icon_file_id = {int(step): str(file_id) for step, file_id in raw.items()}
+        logger.info("Icon file_ids loaded: %d", len(_icon_file_id))
     except Exception as e:
-        logger.error("Failed to save subscriptions: %s", e)
+        logger.error("Failed to load icon file_ids: %s", e)
+        _icon_file_id = {}
 
 
-def add_subscription(chat_id: int, uid: str, last_percent: Optional[int]) -> None:
+def add_subscription(chat_id: str, uid: str, last_percent: Optional[int]) -> None:
     """Добавить uid в подписки конкретного чата (с последним процентом)."""
-    uid = str(uid)
     logger.info(
         "Adding subscription: chat_id=%s uid=%s last_percent=%s",
         chat_id,
         uid,
         last_percent,
     )
-    if chat_id not in subscriptions:
-        subscriptions[chat_id] = {}
-    prev = subscriptions[chat_id].get(uid)
+    prev = subscriptions.get(chat_id, {}).get(uid)
     if prev != last_percent:
-        subscriptions[chat_id][uid] = last_percent
-        save_subscriptions()
+        _commit("sub", chat=chat_id, uid=uid, percent=last_percent)
 
 
-def get_last_percent(chat_id: int, uid: str) -> Optional[int]:
-    return subscriptions.get(chat_id, {}).get(str(uid))
+def get_last_percent(chat_id: str, uid: str) -> Optional[int]:
+    return subscriptions.get(chat_id, {}).get(uid)
 
 
-def set_last_percent(chat_id: int, uid: str, percent: Optional[int]) -> None:
-    uid = str(uid)
-    if chat_id not in subscriptions:
-        subscriptions[chat_id] = {}
-    subscriptions[chat_id][uid] = percent
-    save_subscriptions()
+def _update_last_percent(chat_id: str, uid: str, percent: Optional[int]) -> None:
+    """Обновить процент после проверки.
+
+    Если подписку успели удалить во время проверки, заново её не создаём;
+    если процент не изменился, журнал не трогаем.
+    """
+    inner = subscriptions.get(chat_id)
+    if inner is not None and uid in inner and inner[uid] != percent:
+        _commit("sub", chat=chat_id, uid=uid, percent=percent)
 
 
-def remove_subscription(chat_id: int, uid: str) -> bool:
+def remove_subscription(chat_id: str, uid: str) -> bool:
     """Удалить uid из подписки. Вернёт True, если реально удалили."""
-    uid = str(uid)
     logger.info("Removing subscription: chat_id=%s uid=%s", chat_id, uid)
     if chat_id not in subscriptions:
         return False
     if uid not in subscriptions[chat_id]:
         return False
-    del subscriptions[chat_id][uid]
-    if not subscriptions[chat_id]:
-        del subscriptions[chat_id]
-    save_subscriptions()
+    _commit("unsub", chat=chat_id, uid=uid)
     return True
 
 
 # ---------------------- РАБОТА С API ----------------------
-def fetch_status(uid: str, timeout: int = 10) -> Optional[RequestStatus]:
-    """Синхронный запрос к API."""
-    url = API_URL.format(uid)
-    logger.info("Fetching status for uid=%s url=%s", uid, url)
-    try:
-        resp = requests.get(
-            url,
-            timeout=timeout,
-            verify=False,
-            headers=API_HEADERS,
-        )
-    except Exception as e:
-        logger.error("Request error for %s: %s", uid, e)
-        return None
+async def _request_json(uid: str, url: str) -> Optional[Any]:
+    """GET к API с повторами при 429/5xx и сетевых сбоях."""
+    for attempt in range(MIDPASS_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(MIDPASS_RETRY_BACKOFF * 2 ** (attempt - 1))
+        retries_left = attempt < MIDPASS_RETRIES
+        try:
+            async with aiohttp_session.get(url) as resp:
+                logger.info("Response for uid=%s: status_code=%s", uid, resp.status)
+                if resp.status in MIDPASS_RETRY_STATUSES and retries_left:
+                    logger.warning(
+                        "Retryable response for %s: %s (attempt %d)",
+                        uid,
+                        resp.status,
+                        attempt + 1,
+                    )
+                    continue
+                if resp.status != 200:
+                    logger.warning("Non-200 response for %s: %s", uid, resp.status)
+                    return None
+
+                try:
+                    return await resp.json(content_type=None)
+                except Exception as e:
+                    logger.error("JSON parse error for %s: %s", uid, e)
+                    return None
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if retries_left:
+                logger.warning("Request error for %s: %s (attempt %d)", uid, e, attempt + 1)
+                continue
+            logger.error("Request error for %s: %s", uid, e)
+            return None
+        except Exception as e:
+            logger.error("Request error for %s: %s", uid, e)
+            return None
+    return None
+
+
+# uid -> (время получения по time.monotonic(), статус); порядок ключей — по времени
+_status_cache: Dict[str, Tuple[float, RequestStatus]] = {}
+# uid -> запрос к API, который уже выполняется
+_status_inflight: Dict[str, "asyncio.Task[Optional[RequestStatus]]"] = {}
 
-    logger.info("Response for uid=%s: status_code=%s", uid, resp.status_code)
-    if resp.status_code != 200:
-        logger.warning("Non-200 response for %s: %s", uid, resp.status_code)
-        return None
 
+async def fetch_status(uid: str) -> Optional[RequestStatus]:
+    """
+    Статус заявления с кешем на STATUS_CACHE_TTL секунд.
+    Одновременные запросы одного uid ждут один и тот же поход в API.
+    """
+    cached = _status_cache.get(uid)
+    if cached is not None and time.monotonic() - cached[0] < STATUS_CACHE_TTL:
+        logger.info("Status for uid=%s served from cache", uid)
+        return cached[1]
+
+    task = _status_inflight.get(uid)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_and_cache(uid))
+        _status_inflight[uid] = task
+    else:
+        logger.info("Joining in-flight request for uid=%s", uid)
+    # shield: отмена одного ожидающего не должна отменять общий запрос
+    return await asyncio.shield(task)
+
+
+async def _fetch_and_cache(uid: str) -> Optional[RequestStatus]:
     try:
-        data = resp.json()
-        logger.debug("JSON for %s: %s", uid, json.dumps(data, ensure_ascii=False))
-    except Exception as e:
-        logger.error("JSON parse error for %s: %s", uid, e)
+        status = await _do_fetch_status(uid)
+        if status is not None:
+            now = time.monotonic()
+            _status_cache.pop(uid, None)
+            _prune_status_cache(now)
+            _status_cache[uid] = (now, status)
+        return status
+    finally:
+        _status_inflight.pop(uid, None)
+
+
+def _prune_status_cache(now: float) -> None:
+    """Выкинуть протухшие записи и не дать кешу вырасти больше STATUS_CACHE_MAXSIZE."""
+    while _status_cache:
+        oldest_uid, (fetched_at, _) = next(iter(_status_cache.items()))
+        if now - fetched_at < STATUS_CACHE_TTL and len(_status_cache) < STATUS_CACHE_MAXSIZE:
+            break
+        del _status_cache[oldest_uid]
+
+
+async def _do_fetch_status(uid: str) -> Optional[RequestStatus]:
+    """Асинхронный запрос к API через общую aiohttp-сессию."""
+    url = API_URL.format(uid)
+    logger.info("Fetching status for uid=%s url=%s", uid, url)
+    data = await _request_json(uid, url)
+    if data is None:
         return None
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("JSON for %s: %s", uid, json.dumps(data, ensure_ascii=False))
 
     try:
         passport = data.get("passportStatus") or {}
@@ -380,12 +844,6 @@ def fetch_status(uid: str, timeout: int = 10) -> Optional[RequestStatus]:
         return None
 
 
-async def fetch_status_async(uid: str, timeout: int = 10) -> Optional[RequestStatus]:
-    loop = asyncio.get_running_loop()
-    logger.debug("Scheduling fetch_status in executor for uid=%s", uid)
-    return await loop.run_in_executor(None, fetch_status, uid, timeout)
-
-
 def format_status_text(status: RequestStatus, label: Optional[str] = None) -> str:
     header = f"Заявление: `{status.uid}`"
     if label:
@@ -407,34 +865,58 @@ def format_status_text(status: RequestStatus, label: Optional[str] = None) -> st
 
 
 # ---------------------- КАРТИНКА С ПРОГРЕССОМ ----------------------
-def create_status_image(status: RequestStatus) -> BytesIO:
+# шаг прогресса -> содержимое PNG (заполняется в post_init)
+_ICON_CACHE: Dict[int, bytes] = {}
+
+# шрифты для fallback-карточки грузим один раз при импорте
+try:
+    _FONT_BIG = ImageFont.truetype("DejaVuSans.ttf", 80)
+    _FONT_SMALL = ImageFont.truetype("DejaVuSans.ttf", 32)
+except Exception:
+    _FONT_BIG = _FONT_SMALL = ImageFont.load_default()
+
+
+def _preload_icons() -> None:
+    """Один раз прочитать все картинки из progress_icons в память."""
+    for step in PROGRESS_STEPS:
+        filename = os.path.join(PROGRESS_DIR, f"progress_{step}.png")
+        try:
+            with open(filename, "rb") as f:
+                _ICON_CACHE[step] = f.read()
+        except OSError as e:
+            logger.warning("Icon file %s not loaded: %s", filename, e)
+    logger.info("Preloaded %d progress icons", len(_ICON_CACHE))
+
+
+def _progress_step(status: RequestStatus) -> Optional[int]:
+    """Ближайший шаг из PROGRESS_STEPS или None, если процента нет / он некорректный."""
+    raw_percent = status.internal_status.percent
+    if isinstance(raw_percent, int) and 0 <= raw_percent <= 100:
+        return _NEAREST[raw_percent]
+    return None
+
+
+def create_status_image(status: RequestStatus) -> Tuple[bytes, Optional[int]]:
     """
     Берём подходящую картинку из progress_icons по проценту.
     Если процента нет / он некорректный / файла нет — рисуем fallback.
+    Возвращает PNG в виде bytes (send_photo принимает их напрямую)
+    и шаг прогресса (None для fallback).
     """
     raw_percent = status.internal_status.percent
-    percent: Optional[int] = None
-    if isinstance(raw_percent, int) and 0 <= raw_percent <= 100:
-        percent = raw_percent
+    nearest = _progress_step(status)
 
-    if percent is not None:
-        nearest = min(PROGRESS_STEPS, key=lambda v: abs(v - percent))
-        filename = os.path.join(PROGRESS_DIR, f"progress_{nearest}.png")
+    if nearest is not None:
         logger.info(
-            "Using local icon for uid=%s: percent=%s -> nearest=%s file=%s",
+            "Using cached icon for uid=%s: percent=%s -> nearest=%s",
             status.uid,
-            percent,
+            raw_percent,
             nearest,
-            filename,
         )
-        if os.path.exists(filename):
-            with open(filename, "rb") as f:
-                data = f.read()
-            buf = BytesIO(data)
-            buf.seek(0)
-            return buf
-        else:
-            logger.warning("Icon file %s not found, using fallback image", filename)
+        data = _ICON_CACHE.get(nearest)
+        if data is not None:
+            return data, nearest
+        logger.warning("Icon for step %s not loaded, using fallback image", nearest)
     else:
         logger.warning(
             "Percent value %r for uid=%s is invalid; using fallback image",
@@ -443,14 +925,75 @@ def create_status_image(status: RequestStatus) -> BytesIO:
         )
 
     # Fallback: простая карточка с текстом процента
+    return _render_fallback_png(raw_percent), None
+
+
+def _is_file_id_error(error: BadRequest) -> bool:
+    """Отказ именно из-за file_id, а не из-за чата или подписи."""
+    text = str(error).lower()
+    # "wrong file identifier", "file reference expired" / FILE_REFERENCE_EXPIRED
+    return any(
+        marker in text
+        for marker in ("file identifier", "file reference", "file_reference")
+    )
+
+
+async def send_status_photo(
+    bot: Any,
+    chat_id: str,
+    status: RequestStatus,
+    caption: str,
+    message_thread_id: Optional[int] = None,
+    reply_to_message_id: Optional[int] = None,
+) -> None:
+    """
+    Отправить картинку статуса. Одинаковые иконки не загружаем заново:
+    после первой отправки Telegram отдаёт file_id, который и переиспользуем.
+    message_thread_id — тема форума, reply_to_message_id — сообщение,
+    на которое отвечаем (как делает reply_photo в группах).
+    """
+    # если иконка уже есть в Telegram, картинку даже не достаём
+    step = _progress_step(status)
+    file_id = _icon_file_id.get(step) if step is not None else None
+    if file_id is not None:
+        try:
+            await bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id,
+                caption=caption,
+                parse_mode="Markdown",
+                message_thread_id=message_thread_id,
+                reply_to_message_id=reply_to_message_id,
+            )
+            return
+        except BadRequest as e:
+            # "Chat not found", кривая разметка в подписи и т.п. к file_id
+            # отношения не имеют — пусть их обработает вызывающий код
+            if not _is_file_id_error(e):
+                raise
+            # file_id мог протухнуть (например, сменился бот) — загружаем заново
+            logger.warning("Cached file_id for step %s rejected: %s", step, e)
+            _commit("icon", step=step, file_id=None)
+
+    image, step = create_status_image(status)
+    message = await bot.send_photo(
+        chat_id=chat_id,
+        photo=image,
+        caption=caption,
+        parse_mode="Markdown",
+        message_thread_id=message_thread_id,
+        reply_to_message_id=reply_to_message_id,
+    )
+    if step is not None and message.photo:
+        _commit("icon", step=step, file_id=message.photo[-1].file_id)
+
+
+@functools.lru_cache(maxsize=128)
+def _render_fallback_png(raw_percent: Optional[int]) -> bytes:
+    """Карточка зависит только от процента, поэтому готовый PNG кешируем."""
     img = Image.new("RGB", (300, 300), (60, 60, 60))
     draw = ImageDraw.Draw(img)
-    try:
-        font_big = ImageFont.truetype("DejaVuSans.ttf", 80)
-        font_small = ImageFont.truetype("DejaVuSans.ttf", 32)
-    except Exception:
-        font_big = ImageFont.load_default()
-        font_small = ImageFont.load_default()
+    font_big, font_small = _FONT_BIG, _FONT_SMALL
 
     label = (
         f"{raw_percent}%"
@@ -474,12 +1017,26 @@ def create_status_image(status: RequestStatus) -> BytesIO:
     draw.text((x2, y2), sub, font=font_small, fill=(200, 200, 200))
 
     buf = BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return buf
+    # картинка простая и кешируется, так что сильное сжатие только тратит CPU
+    img.save(buf, format="PNG", compress_level=1, optimize=False)
+    return buf.getvalue()
 
 
 # ---------------------- HANDLERS ----------------------
+# Повторяющиеся ответы — одна строка на всех, без копий в каждой команде
+MSG_MODE_DAILY = (
+    "Режим уведомлений изменён.\n"
+    "Теперь я буду каждый день присылать статусы по всем отслеживаемым номерам, "
+    "даже если процент не изменился."
+)
+MSG_MODE_ON_CHANGE = (
+    "Режим уведомлений изменён.\n"
+    "Теперь я буду присылать уведомления только если изменился процент готовности."
+)
+MSG_ERASED = "Все данные для этого чата удалены: номера, настройки уведомлений и ярлыки."
+MSG_NOTHING_TO_ERASE = "Для этого чата не было сохранённых данных."
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id if update.effective_chat else None
     logger.info("Received /start from chat_id=%s", chat_id)
@@ -512,7 +1069,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 async def label_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
+    chat_id = str(update.effective_chat.id)
     logger.info("/label from chat_id=%s args=%s", chat_id, context.args)
 
     if not context.args:
@@ -556,12 +1113,14 @@ async def label_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
 
 
+# номер заявления — непрерывная последовательность минимум из 10 цифр
+_UID_RE = re.compile(r"\d{10,}")
+
+
 def extract_uid(text: str) -> Optional[str]:
-    digits = "".join(ch for ch in text if ch.isdigit())
-    logging.debug("extract_uid: text=%r digits=%r", text, digits)
-    if len(digits) < 10:
-        return None
-    return digits
+    m = _UID_RE.search(text)
+    logging.debug("extract_uid: text=%r match=%r", text, m)
+    return m.group(0) if m else None
 
 
 async def handle_uid_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -570,7 +1129,11 @@ async def handle_uid_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     raw_text = update.message.text.strip()
-    chat_id = update.effective_chat.id if update.effective_chat else None
+    # Номер — минимум 10 цифр; короткую болтовню в группах отсекаем
+    # ещё до логирования и регулярки.
+    if len(raw_text) < 10:
+        return
+    chat_id = str(update.effective_chat.id) if update.effective_chat else None
     logger.info("New text message from chat_id=%s: %r", chat_id, raw_text)
 
     uid = extract_uid(raw_text)
@@ -586,8 +1149,7 @@ async def handle_uid_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
         parse_mode="Markdown",
     )
 
-    # Асинхронно дергаем API в отдельном потоке
-    status = await fetch_status_async(uid)
+    status = await fetch_status(uid)
     if not status:
         logger.info("Status for uid=%s not obtained (None)", uid)
         await update.message.reply_text(
@@ -599,17 +1161,27 @@ async def handle_uid_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Текст + картинка
     label = get_label(chat_id, status.uid) if chat_id is not None else None
     caption = format_status_text(status, label)
-    image_buf = create_status_image(status)
 
     logger.info("Sending photo with status for uid=%s to chat_id=%s", status.uid, chat_id)
-    await update.message.reply_photo(photo=image_buf, caption=caption, parse_mode="Markdown")
+    # как reply_photo: в теме форума картинка уходит в ту же тему, а не в General,
+    # а вне личных чатов цитирует сообщение с номером
+    thread_id = update.message.message_thread_id if update.message.is_topic_message else None
+    reply_to = update.message.message_id if update.message.chat.type != "private" else None
+    await send_status_photo(
+        context.bot,
+        chat_id,
+        status,
+        caption,
+        message_thread_id=thread_id,
+        reply_to_message_id=reply_to,
+    )
 
     # добавляем в подписку и запоминаем процент
     add_subscription(chat_id, status.uid, status.internal_status.percent)
 
 
 async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
+    chat_id = str(update.effective_chat.id)
     logger.info("/list from chat_id=%s", chat_id)
     uids = subscriptions.get(chat_id, {})
     if not uids:
@@ -626,7 +1198,7 @@ async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 async def remove_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
+    chat_id = str(update.effective_chat.id)
     logger.info("/remove from chat_id=%s args=%s", chat_id, context.args)
     if not context.args:
         await update.message.reply_text("Использование: /remove <uid>")
@@ -646,22 +1218,13 @@ async def remove_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
+    chat_id = str(update.effective_chat.id)
     logger.info("/clear from chat_id=%s", chat_id)
 
-    had_any = False
-
-    if chat_id in subscriptions:
-        del subscriptions[chat_id]
-        save_subscriptions()
-        had_any = True
-
-    if chat_id in labels:
-        del labels[chat_id]
-        save_labels()
-        had_any = True
+    # drop сам сообщает, где что-то было, поэтому без проверок "in"
+    removed = _commit("drop", chat=chat_id, stores=["subs", "labels"])
 
-    if had_any:
+    if removed:
         await update.message.reply_text("Все номера и ярлыки для этого чата удалены.")
     else:
         await update.message.reply_text("И так ничего не отслеживаю.")
@@ -672,7 +1235,7 @@ async def manual_check_command(update: Update, context: ContextTypes.DEFAULT_TYP
     Ручная проверка всех номеров этого чата.
     Всегда шлёт статусы, но при этом обновляет last_percent.
     """
-    chat_id = update.effective_chat.id
+    chat_id = str(update.effective_chat.id)
     logger.info("/check from chat_id=%s", chat_id)
     uids = subscriptions.get(chat_id, {})
     if not uids:
@@ -681,29 +1244,35 @@ async def manual_check_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
     await update.message.reply_text("Проверяю статусы...")
 
-    for uid in list(uids.keys()):
-        logger.info("Manual check uid=%s for chat_id=%s", uid, chat_id)
-        status = await fetch_status_async(uid)
-        if not status:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"Не удалось получить статус по номеру `{uid}`.",
-                parse_mode="Markdown",
-            )
-            continue
+    sem = asyncio.Semaphore(MIDPASS_CONCURRENCY)
 
-        label = get_label(chat_id, uid)
-        caption = format_status_text(status, label)
-        image_buf = create_status_image(status)
-        await context.bot.send_photo(
-            chat_id=chat_id,
-            photo=image_buf,
-            caption=caption,
-            parse_mode="Markdown",
-        )
+    async def _check_one(uid: str) -> None:
+        async with sem:
+            logger.info("Manual check uid=%s for chat_id=%s", uid, chat_id)
+            status = await fetch_status(uid)
+            if not status:
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=f"Не удалось получить статус по номеру `{uid}`.",
+                    parse_mode="Markdown",
+                )
+                return
+
+            label = get_label(chat_id, uid)
+            caption = format_status_text(status, label)
+            await send_status_photo(context.bot, chat_id, status, caption)
+
+            # обновляем last_percent: изменение уходит строкой в журнал,
+            # снимки перепишет компактизация
+            _update_last_percent(chat_id, uid, status.internal_status.percent)
 
-        # обновляем last_percent
-        set_last_percent(chat_id, uid, status.internal_status.percent)
+    results = await asyncio.gather(
+        *(_check_one(uid) for uid in list(uids.keys())),
+        return_exceptions=True,
+    )
+    for r in results:
+        if isinstance(r, Exception):
+            logger.error("Manual check failed in chat %s: %s", chat_id, r)
 
 
 # ---------------------- JOBQUEUE: ежедневная проверка ----------------------
@@ -718,61 +1287,84 @@ async def scheduled_check(context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.info("No subscriptions to check")
         return
 
-    for chat_id, uids in list(subscriptions.items()):
-        logger.info("Checking chat_id=%s with uids=%s", chat_id, list(uids.keys()))
-        for uid in list(uids.keys()):
-            logger.info("Scheduled check uid=%s for chat_id=%s", uid, chat_id)
-            status = await fetch_status_async(uid)
-            if not status:
-                try:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"Не удалось получить статус по номеру `{uid}`.",
-                        parse_mode="Markdown",
-                    )
-                except Exception as e:
-                    logger.error("Failed to send error message to chat %s: %s", chat_id, e)
-                continue
+    sem = asyncio.Semaphore(MIDPASS_CONCURRENCY)
+
+    async def _fetch_one(uid: str) -> Optional[RequestStatus]:
+        async with sem:
+            logger.info("Scheduled check uid=%s", uid)
+            return await fetch_status(uid)
+
+    # один и тот же номер могут отслеживать несколько чатов — запрашиваем его один раз
+    all_uids = list(uid_to_chats)
+    logger.info("Fetching %d unique uids (concurrency=%d)", len(all_uids), MIDPASS_CONCURRENCY)
+    fetched = await asyncio.gather(*(_fetch_one(uid) for uid in all_uids), return_exceptions=True)
+    status_by_uid: Dict[str, Optional[RequestStatus]] = {}
+    for uid, result in zip(all_uids, fetched):
+        if isinstance(result, Exception):
+            logger.error("Fetch task for uid=%s failed: %s", uid, result)
+            result = None
+        status_by_uid[uid] = result
+
+    async def _check_one(chat_id: str, uid: str) -> None:
+        status = status_by_uid.get(uid)
+        if not status:
+            try:
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=f"Не удалось получить статус по номеру `{uid}`.",
+                    parse_mode="Markdown",
+                )
+            except Exception as e:
+                logger.error("Failed to send error message to chat %s: %s", chat_id, e)
+            return
 
-            last_percent = get_last_percent(chat_id, uid)
-            current_raw = status.internal_status.percent
-            current_percent = _normalize_last_percent(current_raw)
+        last_percent = get_last_percent(chat_id, uid)
+        current_raw = status.internal_status.percent
+        current_percent = _normalize_last_percent(current_raw)
 
-            mode = get_notify_mode(chat_id)
+        mode = get_notify_mode(chat_id)
 
+        logger.info(
+            "UID %s in chat %s: mode=%s last_percent=%s current_percent=%s",
+            uid,
+            chat_id,
+            mode.name,
+            last_percent,
+            current_percent,
+        )
+
+        # Проверка режима идёт до любой работы с картинками: без изменений
+        # в on_change на этот номер тратится только HTTP-запрос.
+        if mode is Mode.ON_CHANGE and last_percent == current_percent:
             logger.info(
-                "UID %s in chat %s: mode=%s last_percent=%s current_percent=%s",
+                "No change for uid=%s in chat_id=%s with mode=on_change, skip notify",
                 uid,
                 chat_id,
-                mode,
-                last_percent,
-                current_percent,
             )
+            return
 
-            if mode == "on_change" and last_percent == current_percent:
-                logger.info(
-                    "No change for uid=%s in chat_id=%s with mode=on_change, skip notify",
-                    uid,
-                    chat_id,
-                )
-                continue
-
-            # процент изменился -> отправляем
-            label = get_label(chat_id, uid)
-            caption = format_status_text(status, label)
-            image_buf = create_status_image(status)
-            try:
-                await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=image_buf,
-                    caption=caption,
-                    parse_mode="Markdown",
-                )
-            except Exception as e:
-                logger.error("Failed to send photo to chat %s: %s", chat_id, e)
-
-            # обновляем сохранённый процент
-            set_last_percent(chat_id, uid, current_percent)
+        # процент изменился -> отправляем
+        label = get_label(chat_id, uid)
+        caption = format_status_text(status, label)
+        try:
+            await send_status_photo(context.bot, chat_id, status, caption)
+        except Exception as e:
+            logger.error("Failed to send photo to chat %s: %s", chat_id, e)
+
+        # обновляем сохранённый процент: запись в журнал, снимки — при компактизации
+        _update_last_percent(chat_id, uid, current_percent)
+
+    tasks = [
+        _check_one(chat_id, uid)
+        for uid, chats in list(uid_to_chats.items())
+        if uid in status_by_uid
+        for chat_id in list(chats)
+    ]
+    logger.info("Notifying %d subscriptions", len(tasks))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for r in results:
+        if isinstance(r, Exception):
+            logger.error("Scheduled check task failed: %s", r)
 
 
 # ---------------------- ERROR HANDLER ----------------------
@@ -795,13 +1387,13 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 
 async def mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
+    chat_id = str(update.effective_chat.id)
     logger.info("/mode from chat_id=%s args=%s", chat_id, context.args)
 
     current_mode = get_notify_mode(chat_id)
 
     if not context.args:
-        if current_mode == "daily":
+        if current_mode is Mode.DAILY:
             desc = (
                 "Сейчас режим: ежедневно.\n\n"
                 "Я буду каждый день присылать статусы по всем отслеживаемым номерам, "
@@ -824,20 +1416,11 @@ async def mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     arg = context.args[0].lower()
 
     if arg in ("daily", "ежедневно"):
-        chat_notify_mode[chat_id] = "daily"
-        save_chat_prefs()
-        await update.message.reply_text(
-            "Режим уведомлений изменён.\n"
-            "Теперь я буду каждый день присылать статусы по всем отслеживаемым номерам, "
-            "даже если процент не изменился."
-        )
+        _commit("mode", chat=chat_id, mode=Mode.DAILY)
+        await update.message.reply_text(MSG_MODE_DAILY)
     elif arg in ("on_change", "change", "по_изменению"):
-        chat_notify_mode[chat_id] = "on_change"
-        save_chat_prefs()
-        await update.message.reply_text(
-            "Режим уведомлений изменён.\n"
-            "Теперь я буду присылать уведомления только если изменился процент готовности."
-        )
+        _commit("mode", chat=chat_id, mode=Mode.ON_CHANGE)
+        await update.message.reply_text(MSG_MODE_ON_CHANGE)
     else:
         await update.message.reply_text(
             "Не понял режим.\n"
@@ -848,57 +1431,60 @@ async def mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 async def mode_daily_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
+    chat_id = str(update.effective_chat.id)
     logger.info("/mode_daily from chat_id=%s", chat_id)
-    chat_notify_mode[chat_id] = "daily"
-    save_chat_prefs()
-    await update.message.reply_text(
-        "Режим уведомлений изменён.\n"
-        "Теперь я буду каждый день присылать статусы по всем отслеживаемым номерам, "
-        "даже если процент не изменился."
-    )
+    _commit("mode", chat=chat_id, mode=Mode.DAILY)
+    await update.message.reply_text(MSG_MODE_DAILY)
 
 
 async def mode_on_change_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
+    chat_id = str(update.effective_chat.id)
     logger.info("/mode_on_change from chat_id=%s", chat_id)
-    chat_notify_mode[chat_id] = "on_change"
-    save_chat_prefs()
-    await update.message.reply_text(
-        "Режим уведомлений изменён.\n"
-        "Теперь я буду присылать уведомления только если изменился процент готовности."
-    )
+    _commit("mode", chat=chat_id, mode=Mode.ON_CHANGE)
+    await update.message.reply_text(MSG_MODE_ON_CHANGE)
 
 
 async def erase_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
+    chat_id = str(update.effective_chat.id)
     logger.info("/erase_data from chat_id=%s", chat_id)
 
-    removed_anything = False
-
-    if chat_id in subscriptions:
-        del subscriptions[chat_id]
-        save_subscriptions()
-        removed_anything = True
+    # одна запись в журнале вместо перезаписи трёх файлов; drop сам
+    # сообщает, где что-то было, так что отдельные проверки "in" не нужны
+    removed = _commit("drop", chat=chat_id, stores=["subs", "prefs", "labels"])
 
-    if chat_id in chat_notify_mode:
-        del chat_notify_mode[chat_id]
-        save_chat_prefs()
-        removed_anything = True
+    if removed:
+        await update.message.reply_text(MSG_ERASED)
+    else:
+        await update.message.reply_text(MSG_NOTHING_TO_ERASE)
+
+
+# ---------------------- LIFECYCLE ----------------------
+async def post_init(application: Application) -> None:
+    global aiohttp_session
+    _preload_icons()
+    start_journal_writer()
+    logger.info("Creating aiohttp session for MIDPASS API")
+    aiohttp_session = aiohttp.ClientSession(
+        headers=API_HEADERS,
+        connector=aiohttp.TCPConnector(limit=64, limit_per_host=16, ssl=False),
+        timeout=aiohttp.ClientTimeout(total=10),
+    )
 
-    if chat_id in labels:
-        del labels[chat_id]
-        save_labels()
-        removed_anything = True
 
-    if removed_anything:
-        await update.message.reply_text(
-            "Все данные для этого чата удалены: номера, настройки уведомлений и ярлыки."
-        )
-    else:
-        await update.message.reply_text(
-            "Для этого чата не было сохранённых данных."
-        )
+async def post_shutdown(application: Application) -> None:
+    global aiohttp_session
+    if _compaction_task is not None:
+        # упавшая компактизация не должна помешать сбросить журнал и снимки
+        try:
+            await _compaction_task
+        except Exception as e:
+            logger.error("Background compaction failed: %s", e)
+    await stop_journal_writer()
+    compact()
+    if aiohttp_session is not None:
+        logger.info("Closing aiohttp session")
+        await aiohttp_session.close()
+        aiohttp_session = None
 
 
 # ---------------------- MAIN ----------------------
@@ -909,9 +1495,16 @@ def main() -> None:
             "Установи переменную окружения TELEGRAM_BOT_TOKEN с токеном бота."
         )
 
+    if uvloop is not None:
+        logger.info("Using uvloop event loop")
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     load_subscriptions()
     load_chat_prefs()
     load_labels()
+    load_icon_file_ids()
+    replay_journal()
+    compact()
 
     application = (
         Application.builder()
@@ -920,27 +1513,38 @@ def main() -> None:
         .write_timeout(30.0)
         .connect_timeout(30.0)
         .pool_timeout(30.0)
+        # рассылка фото по многим чатам не должна упираться в один коннект,
+        # а лимиты Telegram (~30 сообщений/с) соблюдает AIORateLimiter
+        .connection_pool_size(32)
+        .get_updates_connection_pool_size(4)
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
     application.add_error_handler(error_handler)
 
-    # Команды
-    application.add_handler(CommandHandler(["start", "help"], start))
-    application.add_handler(CommandHandler("list", list_command))
-    application.add_handler(CommandHandler("remove", remove_command))
-    application.add_handler(CommandHandler("clear", clear_command))
-    application.add_handler(CommandHandler("check", manual_check_command))
-    application.add_handler(CommandHandler("mode", mode_command))
-    application.add_handler(CommandHandler("mode_daily", mode_daily_command))
-    application.add_handler(CommandHandler("mode_on_change", mode_on_change_command))
-    application.add_handler(CommandHandler("erase_data", erase_data_command))
-    application.add_handler(CommandHandler("label", label_command))
-
-
+    # Команды. block=False: пока /check ждёт Midpass, остальные апдейты
+    # обрабатываются дальше, а не стоят в очереди за ним.
+    commands = {
+        ("start", "help"): start,
+        "list": list_command,
+        "remove": remove_command,
+        "clear": clear_command,
+        "check": manual_check_command,
+        "mode": mode_command,
+        "mode_daily": mode_daily_command,
+        "mode_on_change": mode_on_change_command,
+        "erase_data": erase_data_command,
+        "label": label_command,
+    }
+    application.add_handlers(
+        [CommandHandler(names, callback, block=False) for names, callback in commands.items()]
+    )
 
     # Любой текст — пытаемся вытащить из него номер заявления
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_uid_message)
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_uid_message, block=False)
     )
 
     # Планируем ежедневную задачу в 08:00 UTC
@@ -948,10 +1552,28 @@ def main() -> None:
         callback=scheduled_check,
         time=dtime(hour=DAILY_CHECK_HOUR_UTC, minute=0, tzinfo=timezone.utc),
         name="daily_midpass_check",
+        # опоздавший запуск (занятый цикл событий) всё равно выполнится;
+        # coalesce и max_instances=1 — и так значения по умолчанию у задач APScheduler
+        job_kwargs={"misfire_grace_time": DAILY_CHECK_MISFIRE_GRACE},
+    )
+    application.job_queue.run_repeating(
+        callback=compact_job,
+        interval=JOURNAL_COMPACT_INTERVAL,
+        first=JOURNAL_COMPACT_INTERVAL,
+        name="compact_state_journal",
     )
 
     logger.info("Bot started. Daily check at %02d:00 UTC", DAILY_CHECK_HOUR_UTC)
-    application.run_polling()
+    if PUBLIC_HOST:
+        logger.info("Using webhook on https://%s (listening on port %s)", PUBLIC_HOST, WEBHOOK_PORT)
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"https://{PUBLIC_HOST}/{TELEGRAM_BOT_TOKEN}",
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":